@@ -16,6 +16,7 @@ USERNAME = os.getenv("USERNAME", "")
 USER_PWD = os.getenv("USERPWD", "")
 DB_NAME = os.getenv("DB_NAME", "")
 KINESIS_TARGET = os.getenv("KINESIS_TARGET", "default")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "1"))
 SCHEMA_NAME = "public"
 
 
@@ -144,7 +145,17 @@ def create_replication_task(
             }
         ]
     }
-    replication_task_settings = {"Logging": {"EnableLogging": True}}
+    if replication_task_settings is None:
+        replication_task_settings = {
+            "Logging": {"EnableLogging": True},
+            # Kinesis targets apply CDC changes in parallel through the
+            # ParallelApply* settings, batch apply only covers relational targets
+            "TargetMetadata": {
+                "ParallelApplyThreads": 8,
+                "ParallelApplyBufferSize": 500,
+                "ParallelApplyQueuesPerThread": 4,
+            },
+        }
 
     return dms.CfnReplicationTask(
         stack,
@@ -201,7 +212,7 @@ def create_security_group(stack: Stack, vpc: ec2.Vpc) -> ec2.SecurityGroup:
 
 def create_kinesis_stream(stack: Stack, dms_assume_role: iam.Role) -> kinesis.Stream:
     stream = kinesis.Stream(
-        stack, "TargetStream", shard_count=1, retention_period=cdk.Duration.hours(24)
+        stack, "TargetStream", shard_count=SHARD_COUNT, retention_period=cdk.Duration.hours(24)
     )
     stream.grant_read_write(dms_assume_role)
     stream.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
@@ -243,6 +254,8 @@ def create_kinesis_target_endpoint(stack: Stack, target_stream: kinesis.Stream,
                 include_partition_value=True,
                 include_table_alter_operations=True,
                 include_transaction_details=False,
+                # records are keyed by primary key; prefixing schema/table spreads
+                # equal keys from different tables across shards
                 partition_include_schema_table=True,
             ),
         )
@@ -291,11 +304,15 @@ def create_replication_instance(
         subnet_ids=[subnet.subnet_id for subnet in vpc.public_subnets],
     )
 
+    # CDC throughput is bound by the instance CPU/memory, override via CDK context
+    instance_class = stack.node.try_get_context("dms_instance_class") or "dms.c5.large"
+    allocated_storage = int(stack.node.try_get_context("dms_allocated_storage") or 50)
+
     return dms.CfnReplicationInstance(
         stack,
         "replication-instance",
-        replication_instance_class="dms.t2.micro",
-        allocated_storage=5,
+        replication_instance_class=instance_class,
+        allocated_storage=allocated_storage,
         replication_subnet_group_identifier=replication_subnet_group.ref,
         allow_major_version_upgrade=False,
         auto_minor_version_upgrade=False,
@@ -1,13 +1,24 @@
 import json
 import os
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache, partial
 from pprint import pprint
-from time import sleep
-from typing import Callable, TypedDict, TypeVar
+from queue import Empty, Queue
+from threading import Event
+from typing import Callable, NamedTuple, TypeVar
 
+import orjson
 import psycopg2
+from psycopg2.extensions import make_dsn
 from psycopg2.extras import RealDictCursor
-from boto3 import client
+from boto3.session import Session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.exceptions import ReadTimeoutError as BotocoreReadTimeoutError
+from urllib3.exceptions import ReadTimeoutError
 
 from lib import query as q
 
@@ -15,24 +26,46 @@ STACK_NAME = os.getenv("STACK_NAME", "DMSPostgresKinesis")
 
 ENDPOINT_URL = os.getenv("ENDPOINT_URL")
 KINESIS_TARGET = os.getenv("KINESIS_TARGET", "default")
+KINESIS_CONSUMER = os.getenv("KINESIS_CONSUMER", "polling")
+KINESIS_CONSUMER_NAME = os.getenv("KINESIS_CONSUMER_NAME", "dms-sample-consumer")
 
-cfn = client("cloudformation", endpoint_url=ENDPOINT_URL)
-dms = client("dms", endpoint_url=ENDPOINT_URL)
-kinesis = client("kinesis", endpoint_url=ENDPOINT_URL)
-secretsmanager = client("secretsmanager", endpoint_url=ENDPOINT_URL)
+
+# the session and clients are only created on first use, importing run.py has no
+# boto3 side effects
+@lru_cache(maxsize=1)
+def get_session() -> Session:
+    return Session()
+
+
+@lru_cache(maxsize=None)
+def get_client(service_name: str, read_timeout: int = 60):
+    client_config = Config(
+        max_pool_connections=20,
+        retries={"mode": "adaptive", "max_attempts": 10},
+        read_timeout=read_timeout,
+    )
+    return get_session().client(
+        service_name, endpoint_url=ENDPOINT_URL, config=client_config
+    )
 
 
 retries = 100 if not ENDPOINT_URL else 10
 retry_sleep = 5 if not ENDPOINT_URL else 1
+# bounds how long a stopped enhanced fan-out reader can block waiting for an event
+subscription_read_timeout = 10
+READ_TIMEOUT_ERRORS = (BotocoreReadTimeoutError, ReadTimeoutError)
+
+# shards and their iterators per stream ARN, reused across wait_for_kinesis calls
+_shard_state: dict[str, dict] = {}
 
 
-class CfnOutput(TypedDict):
+class CfnOutput(NamedTuple):
     cdcTask: str
     kinesisStream: str
     dbSecret: str
 
 
-class Credentials(TypedDict):
+class Credentials(NamedTuple):
     host: str
     dbname: str
     username: str
@@ -40,27 +73,25 @@ class Credentials(TypedDict):
     port: int
 
 
-def get_cfn_output():
-    stacks = cfn.describe_stacks()["Stacks"]
-    stack = None
-    for s in stacks:
-        if s["StackName"] == STACK_NAME:
-            stack = s
-            break
-    if not stack:
-        raise Exception(f"Stack {STACK_NAME} Not found")
-
-    outputs = stack["Outputs"]
-    cfn_output = CfnOutput()
-    for output in outputs:
-        cfn_output[output["OutputKey"]] = output["OutputValue"]
-    return cfn_output
+@lru_cache(maxsize=1)
+def get_cfn_output() -> CfnOutput:
+    cfn = get_client("cloudformation")
+    try:
+        stack = cfn.describe_stacks(StackName=STACK_NAME)["Stacks"][0]
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "ValidationError":
+            raise
+        raise Exception(f"Stack {STACK_NAME} Not found") from error
+    # cached, so handed out as an immutable tuple
+    outputs = {output["OutputKey"]: output["OutputValue"] for output in stack["Outputs"]}
+    return CfnOutput(**{field: outputs[field] for field in CfnOutput._fields})
 
 
+@lru_cache(maxsize=1)
 def get_credentials(secret_arn: str) -> Credentials:
-    secret_value = secretsmanager.get_secret_value(SecretId=secret_arn)
-    credentials = Credentials(**json.loads(secret_value["SecretString"]))
-    return credentials
+    secret_value = get_client("secretsmanager").get_secret_value(SecretId=secret_arn)
+    secret = json.loads(secret_value["SecretString"])
+    return Credentials(**{field: secret[field] for field in Credentials._fields})
 
 
 T = TypeVar("T")
@@ -69,69 +100,62 @@ T = TypeVar("T")
 def retry(
     function: Callable[..., T], retries=retries, sleep=retry_sleep, **kwargs
 ) -> T:
+    # exponential backoff with jitter, starting small and capped at `sleep`
     raise_error = None
     retries = int(retries)
+    delay = min(0.2, sleep)
     for i in range(0, retries + 1):
         try:
             return function(**kwargs)
         except Exception as error:
             raise_error = error
-            time.sleep(sleep)
+            time.sleep(delay + random.uniform(0, delay * 0.1))
+            delay = min(delay * 2, sleep)
     raise raise_error
 
 
+def get_dsn(credentials: Credentials) -> str:
+    return make_dsn(
+        user=credentials.username,
+        password=credentials.password,
+        host=credentials.host,
+        dbname=credentials.dbname,
+        port=int(credentials.port),
+        # the demo tables are throwaway, no need to wait for the WAL flush on commit
+        options="-c synchronous_commit=off",
+    )
+
+
 def run_queries_on_postgres(
-    credentials: Credentials,
-    queries: list[str],
+    cnx,
+    *batches: list[str],
+    multi_statement: bool = True,
 ):
-    cursor = None
-    cnx = None
-    try:
-        cnx = psycopg2.connect(
-            user=credentials["username"],
-            password=credentials["password"],
-            host=credentials["host"],
-            dbname=credentials["dbname"],
-            cursor_factory=RealDictCursor,
-            port=int(credentials["port"]),
-        )
-        cursor = cnx.cursor()
-        for query in queries:
-            cursor.execute(query)
-        cnx.commit()
-    finally:
-        if cursor:
-            cursor.close()
-        if cnx:
-            cnx.close()
+    # statements are ";"-terminated, all batches are sent together as one
+    # multi-statement query and committed as one transaction. DDL captured by DMS
+    # must run one statement per execute: its event trigger records
+    # current_query(), which would otherwise hold the whole batch for every event
+    queries = [query for batch in batches for query in batch]
+    with cnx.cursor() as cursor:
+        if multi_statement:
+            cursor.execute("\n".join(queries))
+        else:
+            for query in queries:
+                cursor.execute(query)
+    cnx.commit()
 
 
 def get_query_result(
-    credentials: Credentials,
+    cnx,
     query: str,
 ):
-    cursor = None
-    cnx = None
-    try:
-        cnx = psycopg2.connect(
-            user=credentials["username"],
-            password=credentials["password"],
-            host=credentials["host"],
-            dbname=credentials["dbname"],
-            cursor_factory=RealDictCursor,
-            port=int(credentials["port"]),
-        )
-        cursor = cnx.cursor()
+    with cnx.cursor(cursor_factory=RealDictCursor) as cursor:
         cursor.execute(query)
         return cursor.fetchall()
-    finally:
-        if cursor:
-            cursor.close()
-        if cnx:
-            cnx.close()
+
 
 def start_task(task: str):
-    response = dms.start_replication_task(
+    response = get_client("dms").start_replication_task(
         ReplicationTaskArn=task, StartReplicationTaskType="start-replication"
     )
     status = response["ReplicationTask"].get("Status")
@@ -139,7 +163,7 @@ def start_task(task: str):
 
 
 def stop_task(task: str):
-    response = dms.stop_replication_task(ReplicationTaskArn=task)
+    response = get_client("dms").stop_replication_task(ReplicationTaskArn=task)
     status = response["ReplicationTask"].get("Status")
     print(f"\n Replication Task {task} status: {status}")
 
@@ -147,53 +171,274 @@ def stop_task(task: str):
 def wait_for_task_status(task: str, expected_status: str):
     print(f"Waiting for task status {expected_status}")
 
-    def _wait_for_status():
-        status = dms.describe_replication_tasks(
+    delay = 0.5
+    deadline = time.monotonic() + retries * retry_sleep
+    while True:
+        status = get_client("dms").describe_replication_tasks(
             Filters=[{"Name": "replication-task-arn", "Values": [task]}],
             WithoutSettings=True,
         )["ReplicationTasks"][0].get("Status")
         print(f"{task=} {status=}")
-        assert status == expected_status
+        if status == expected_status:
+            return
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Task {task} did not reach status {expected_status}")
+        time.sleep(delay)
+        delay = min(delay * 1.5, retry_sleep)
+
 
-    retry(_wait_for_status)
+def get_stream_consumer(stream: str) -> str:
+    # registers (or reuses) the enhanced fan-out consumer and waits until it is active
+    kinesis = get_client("kinesis")
+    try:
+        consumer = kinesis.describe_stream_consumer(
+            StreamARN=stream, ConsumerName=KINESIS_CONSUMER_NAME
+        )["ConsumerDescription"]
+    except kinesis.exceptions.ResourceNotFoundException:
+        consumer = None
+
+    if consumer and consumer["ConsumerStatus"] == "DELETING":
+        # left over from a previous run, it has to be gone before registering again
+        def _wait_for_deleted():
+            try:
+                kinesis.describe_stream_consumer(ConsumerARN=consumer["ConsumerARN"])
+            except kinesis.exceptions.ResourceNotFoundException:
+                return
+            raise AssertionError(f"Consumer {KINESIS_CONSUMER_NAME} is still deleting")
+
+        retry(_wait_for_deleted)
+        consumer = None
+
+    if consumer is None:
+        consumer = kinesis.register_stream_consumer(
+            StreamARN=stream, ConsumerName=KINESIS_CONSUMER_NAME
+        )["Consumer"]
+    consumer_arn = consumer["ConsumerARN"]
+
+    def _wait_for_active():
+        status = kinesis.describe_stream_consumer(ConsumerARN=consumer_arn)[
+            "ConsumerDescription"
+        ]["ConsumerStatus"]
+        assert status == "ACTIVE"
+
+    retry(_wait_for_active)
+    return consumer_arn
+
+
+def deregister_stream_consumer(consumer_arn: str):
+    get_client("kinesis").deregister_stream_consumer(ConsumerARN=consumer_arn)
+
+
+def poll_kinesis_records(
+    stream: str,
+    shard_id: str,
+    sequence_number: str | None,
+    start_time: datetime,
+    records_queue: Queue,
+    stop: Event,
+):
+    kinesis = get_client("kinesis")
+    # continue where the previous call stopped when resuming this shard. The stored
+    # iterator is popped so that a failed read does not leave a stale one behind
+    iterators = _shard_state[stream]["iterators"]
+    shard_iter = iterators.pop(shard_id, None)
+    if not sequence_number or shard_iter is None:
+        if sequence_number:
+            position = {
+                "ShardIteratorType": "AFTER_SEQUENCE_NUMBER",
+                "StartingSequenceNumber": sequence_number,
+            }
+        else:
+            position = {"ShardIteratorType": "AT_TIMESTAMP", "Timestamp": start_time}
+        shard_iterator = kinesis.get_shard_iterator(
+            StreamARN=stream,
+            ShardId=shard_id,
+            **position,
+        )
+        shard_iter = shard_iterator["ShardIterator"]
+    empty_count = 0
+    while shard_iter is not None:
+        res = kinesis.get_records(ShardIterator=shard_iter, Limit=1000)
+        shard_iter = res.get("NextShardIterator")
+        records = res["Records"]
+        if records:
+            records_queue.put((shard_id, records))
+        if stop.is_set():
+            break
+        if records:
+            empty_count = 0
+            continue
+        # only back off on empty polls, stays well below 5 GetRecords/s/shard
+        if stop.wait(min(0.1 * 2**empty_count, 2.0)):
+            break
+        empty_count += 1
+    iterators[shard_id] = shard_iter
 
 
-def wait_for_kinesis(stream: str, expected_count: int, threshold_timestamp: int):
+def open_shard_subscription(
+    consumer_arn: str,
+    shard_id: str,
+    sequence_number: str | None,
+    start_time: datetime,
+):
+    kinesis = get_client("kinesis", read_timeout=subscription_read_timeout)
+    if sequence_number:
+        position = {"Type": "AFTER_SEQUENCE_NUMBER", "SequenceNumber": sequence_number}
+    else:
+        position = {"Type": "AT_TIMESTAMP", "Timestamp": start_time}
+    for attempt in range(3):
+        try:
+            return kinesis.subscribe_to_shard(
+                ConsumerARN=consumer_arn,
+                ShardId=shard_id,
+                StartingPosition=position,
+            )["EventStream"]
+        except kinesis.exceptions.ResourceInUseException:
+            # a shard can only be subscribed to once every 5 seconds per consumer
+            if attempt == 2:
+                raise
+            time.sleep(5)
+
+
+def close_shard_subscriptions(stream: str):
+    subscriptions = _shard_state.get(stream, {}).get("subscriptions", {})
+    for event_stream in subscriptions.values():
+        event_stream.close()
+    subscriptions.clear()
+
+
+def subscribe_kinesis_records(
+    stream: str,
+    consumer_arn: str,
+    shard_id: str,
+    sequence_number: str | None,
+    start_time: datetime,
+    records_queue: Queue,
+    stop: Event,
+):
+    # the subscription stays open across calls when resuming this shard, it is popped
+    # so that a failed read does not leave a broken one behind
+    subscriptions = _shard_state[stream]["subscriptions"]
+    event_stream = subscriptions.pop(shard_id, None)
+    if event_stream is not None and not sequence_number:
+        event_stream.close()
+        event_stream = None
+    try:
+        while True:
+            if event_stream is None:
+                event_stream = open_shard_subscription(
+                    consumer_arn, shard_id, sequence_number, start_time
+                )
+            # records are pushed as they arrive
+            try:
+                for event in event_stream:
+                    records = event["SubscribeToShardEvent"]["Records"]
+                    if records:
+                        records_queue.put((shard_id, records))
+                        sequence_number = records[-1]["SequenceNumber"]
+                    if stop.is_set():
+                        subscriptions[shard_id] = event_stream
+                        return
+            except READ_TIMEOUT_ERRORS:
+                # no event within the read timeout, the stream can not be resumed
+                if stop.is_set():
+                    event_stream.close()
+                    return
+            # the subscription expired or timed out, continue with a new one
+            event_stream.close()
+            event_stream = None
+    except Exception:
+        if event_stream is not None:
+            event_stream.close()
+        raise
+
+
+def wait_for_kinesis(
+    stream: str,
+    expected_count: int,
+    start_time: datetime,
+    sequence_numbers: dict[str, str] | None = None,
+    consumer_arn: str | None = None,
+) -> dict[str, str]:
+    # reads every shard after its sequence number in `sequence_numbers` (or from
+    # `start_time`) and returns the last sequence number seen per shard, to be
+    # passed on to the next call. Records are pushed through `consumer_arn` when
+    # given, otherwise the shards are polled
     print("\n\tKinesis events\n")
     print("fetching Kinesis event")
 
-    shard_id = kinesis.describe_stream(StreamARN=stream)["StreamDescription"]["Shards"][
-        0
-    ]["ShardId"]
-    shard_iterator = kinesis.get_shard_iterator(
-        StreamARN=stream,
-        ShardId=shard_id,
-        ShardIteratorType="TRIM_HORIZON",
-    )
-    shard_iter = shard_iterator["ShardIterator"]
+    sequence_numbers = dict(sequence_numbers or {})
+    if stream not in _shard_state:
+        shards = get_client("kinesis").describe_stream(StreamARN=stream)[
+            "StreamDescription"
+        ]["Shards"]
+        _shard_state[stream] = {
+            "shard_ids": [shard["ShardId"] for shard in shards],
+            "iterators": {},
+            "subscriptions": {},
+        }
+    shard_ids = _shard_state[stream]["shard_ids"]
+    if consumer_arn:
+        # create the subscription client up front, not concurrently from the readers
+        get_client("kinesis", read_timeout=subscription_read_timeout)
+        read_records = partial(subscribe_kinesis_records, stream, consumer_arn)
+    else:
+        read_records = partial(poll_kinesis_records, stream)
+
+    records_queue = Queue()
+    stop = Event()
     all_records = []
-    while shard_iter is not None:
-        res = kinesis.get_records(ShardIterator=shard_iter, Limit=50)
-        shard_iter = res["NextShardIterator"]
-        records = res["Records"]
-        for r in records:
-            if r["ApproximateArrivalTimestamp"].timestamp() > threshold_timestamp:
-                all_records.append(r)
-        if len(all_records) >= expected_count:
-            break
-        print(f"found {len(all_records)}, {expected_count=}")
-        sleep(retry_sleep)
+
+    def _collect(shard_id: str, records: list[dict]):
+        all_records.extend(records)
+        sequence_numbers[shard_id] = records[-1]["SequenceNumber"]
+
+    with ThreadPoolExecutor(max_workers=len(shard_ids)) as executor:
+        futures = [
+            executor.submit(
+                read_records,
+                shard_id,
+                sequence_numbers.get(shard_id),
+                start_time,
+                records_queue,
+                stop,
+            )
+            for shard_id in shard_ids
+        ]
+
+        def _reading():
+            # stop as soon as a reader failed, the others only stop on `stop`
+            if any(future.done() and future.exception() for future in futures):
+                return False
+            return not all(future.done() for future in futures)
+
+        try:
+            while len(all_records) < expected_count and _reading():
+                try:
+                    _collect(*records_queue.get(timeout=0.5))
+                except Empty:
+                    continue
+                print(f"found {len(all_records)}, {expected_count=}")
+        finally:
+            stop.set()
+    # records read by the shard readers before they stopped
+    while not records_queue.empty():
+        _collect(*records_queue.get_nowait())
+    for future in futures:
+        future.result()
+
     print(f"Received: {len(all_records)} events")
     pprint(
         [
-            {**json.loads(record["Data"]), "partition_key": record["PartitionKey"]}
+            {**orjson.loads(record["Data"]), "partition_key": record["PartitionKey"]}
             for record in all_records
         ]
     )
+    return sequence_numbers
 
 
 def describe_table_statistics(task_arn: str):
-    res = dms.describe_table_statistics(
+    res = get_client("dms").describe_table_statistics(
         ReplicationTaskArn=task_arn,
     )
     res["TableStatistics"] = sorted(
@@ -204,58 +449,68 @@ def describe_table_statistics(task_arn: str):
 
 def execute_cdc(cfn_output: CfnOutput):
     # CDC Flow
-    credentials = get_credentials(cfn_output["dbSecret"])
-    task = cfn_output["cdcTask"]
-    stream = cfn_output["kinesisStream"]
+    credentials = get_credentials(cfn_output.dbSecret)
+    dsn = get_dsn(credentials)
+    task = cfn_output.cdcTask
+    stream = cfn_output.kinesisStream
     print("")
     print("*" * 12)
     print("STARTING CDC FLOW")
     print("*" * 12)
-    print(f"db endpoint: {credentials['host']}:{credentials['port']}\n")
-
-    run_queries_on_postgres(credentials, q.DROP_TABLES)
-    print("\tCreating tables")
-    run_queries_on_postgres(credentials, q.CREATE_TABLES)
-
-    threshold_timestamp = int(time.time())
-    print("Starting CDC task")
-    start_task(task)
-    wait_for_task_status(task, "running")
-
-    print("\n****Create table events****\n")
-    # 1 create apply_dms_exception, 3 create
-    wait_for_kinesis(stream, 4, threshold_timestamp)
-    print("\n****End create table events****\n")
-
-    print("\n****INSERT events****\n")
-    sleep(1)
-    threshold_timestamp = int(time.time())
-    sleep(1)
-    run_queries_on_postgres(credentials, q.PRESEED_DATA)
-    # 1 authors, 1 accounts, 1 books
-    wait_for_kinesis(stream, 3, threshold_timestamp)
-    print("\n****End of INSERT events****\n")
-
-    print("\n****ALTER tables events****\n")
-    sleep(1)
-    threshold_timestamp = int(time.time())
-    sleep(1)
-    run_queries_on_postgres(credentials, q.ALTER_TABLES)
-    if str.lower(KINESIS_TARGET) == "non-default":
-        wait_for_kinesis(stream, 3, threshold_timestamp)
-    else:
-        wait_for_kinesis(stream, 0, threshold_timestamp)
-    print("\n****End of ALTER tables events****\n")
+    print(f"db endpoint: {credentials.host}:{credentials.port}\n")
 
-    print("\n****Table Statistics****\n")
-    print("\tTable Statistics tasks")
-    pprint(describe_table_statistics(task))
+    cnx = psycopg2.connect(dsn)
+    consumer_arn = None
+    try:
+        if str.lower(KINESIS_CONSUMER) == "efo":
+            consumer_arn = get_stream_consumer(stream)
 
-    stop_task(task)
-    wait_for_task_status(task, "stopped")
+        print("\tCreating tables")
+        run_queries_on_postgres(cnx, q.DROP_TABLES, q.CREATE_TABLES)
+
+        start_time = datetime.now(timezone.utc)
+        print("Starting CDC task")
+        start_task(task)
+        wait_for_task_status(task, "running")
+
+        print("\n****Create table events****\n")
+        # 1 create apply_dms_exception, 3 create
+        sequence_numbers = wait_for_kinesis(
+            stream, 4, start_time, consumer_arn=consumer_arn
+        )
+        print("\n****End create table events****\n")
 
-    print("\n\tDrop tables")
-    run_queries_on_postgres(credentials, q.DROP_TABLES)
+        print("\n****INSERT events****\n")
+        run_queries_on_postgres(cnx, q.PRESEED_DATA)
+        # 1 authors, 1 accounts, 1 books
+        sequence_numbers = wait_for_kinesis(
+            stream, 3, start_time, sequence_numbers, consumer_arn
+        )
+        print("\n****End of INSERT events****\n")
+
+        print("\n****ALTER tables events****\n")
+        run_queries_on_postgres(cnx, q.ALTER_TABLES, multi_statement=False)
+        if str.lower(KINESIS_TARGET) == "non-default":
+            wait_for_kinesis(stream, 3, start_time, sequence_numbers, consumer_arn)
+        else:
+            wait_for_kinesis(stream, 0, start_time, sequence_numbers, consumer_arn)
+        print("\n****End of ALTER tables events****\n")
+
+        print("\n****Table Statistics****\n")
+        print("\tTable Statistics tasks")
+        pprint(describe_table_statistics(task))
+
+        stop_task(task)
+        wait_for_task_status(task, "stopped")
+
+        print("\n\tDrop tables")
+        run_queries_on_postgres(cnx, q.DROP_TABLES)
+    finally:
+        cnx.close()
+        # EFO consumers are billed while registered, never leave one behind
+        if consumer_arn:
+            close_shard_subscriptions(stream)
+            deregister_stream_consumer(consumer_arn)
 
 
 if __name__ == "__main__":